@@ -1,20 +1,26 @@
-import os
+import functools
+import json
+import pkgutil
+from concurrent.futures import ThreadPoolExecutor
 import click
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
-from matplotlib.backends.backend_pdf import PdfPages
 from pyopenms import *
 
 from ibaqpy.ibaq.ibaqpy_commons import (
     CONDITION,
     NORM_INTENSITY,
+    PEPTIDES_DTYPES,
     PROTEIN_NAME,
     SAMPLE_ID,
-    plot_box_plot,
-    plot_distributions,
     get_accession,
+    write_csv,
+    write_distribution_report,
 )
 
+HISTONES_FILE = "data/histones.json"
+STANDARD_AA = frozenset("ARNDBCEQZGHILKMFPSTWYV")
+
 
 def handle_nonstandard_aa(aa_seq: str) -> (list, str):
     """Any nonstandard amoni acid will be removed.
@@ -22,10 +28,39 @@ def handle_nonstandard_aa(aa_seq: str) -> (list, str):
     :param aa_seq: Protein sequences from multiple database.
     :return: One list contains nonstandard amoni acids and one remain sequence.
     """
-    standard_aa = "ARNDBCEQZGHILKMFPSTWYV"
-    nonstandard_aa_lst = [aa for aa in aa_seq if aa not in standard_aa]
-    considered_seq = "".join([aa for aa in aa_seq if aa in standard_aa])
-    return nonstandard_aa_lst, considered_seq
+    nonstandard_aa_lst = list()
+    considered_aa_lst = list()
+    for aa in aa_seq:
+        if aa in STANDARD_AA:
+            considered_aa_lst.append(aa)
+        else:
+            nonstandard_aa_lst.append(aa)
+    return nonstandard_aa_lst, "".join(considered_aa_lst)
+
+
+@functools.lru_cache(maxsize=None)
+def load_organism_descriptions() -> dict:
+    """Load histones.json on the first lookup and index its organisms by name.
+
+    :return: Dictionary from organism name to its description.
+    """
+    histones = json.loads(pkgutil.get_data("ibaqpy", HISTONES_FILE))
+    return {description["name"]: description for description in histones.values()}
+
+
+def get_organism_histones(organism: str) -> (int, tuple):
+    """Return the genome size and histone proteins of an organism from histones.json.
+
+    :param organism: Organism name, e.g. human.
+    :return: Tuple contains the genome size and the histone protein accessions.
+    """
+    organisms = load_organism_descriptions()
+    if organism.lower() not in organisms:
+        raise ValueError(f"Organism {organism} not found in {HISTONES_FILE}")
+    description = organisms[organism.lower()]
+    if "histone_proteins" not in description:
+        raise ValueError(f"No histone proteins for organism {organism} in {HISTONES_FILE}")
+    return description["genome_size"], tuple(description["histone_proteins"])
 
 
 @click.command("tpa", short_help="Compute TPA values.")
@@ -86,19 +121,25 @@ def tpa_compute(
     """
 
     data = pd.read_csv(
-        peptides, sep=",", usecols=[PROTEIN_NAME, NORM_INTENSITY, SAMPLE_ID, CONDITION]
+        peptides,
+        sep=",",
+        engine="pyarrow",
+        usecols=[PROTEIN_NAME, NORM_INTENSITY, SAMPLE_ID, CONDITION],
+        dtype=PEPTIDES_DTYPES,
     )
-    data[NORM_INTENSITY] = data[NORM_INTENSITY].astype("float")
     data = data.dropna(subset=[NORM_INTENSITY])
     data = data[data[NORM_INTENSITY] > 0]
     print(data.head())
 
-    res = pd.DataFrame(
-        data.groupby([PROTEIN_NAME, SAMPLE_ID, CONDITION])[NORM_INTENSITY].sum()
-    )
-    res = res.reset_index()
-    proteins = res[PROTEIN_NAME].unique().tolist()
-    proteins = sum([i.split(";") for i in proteins], [])
+    res = data.groupby(
+        [PROTEIN_NAME, SAMPLE_ID, CONDITION], observed=True, as_index=False
+    )[NORM_INTENSITY].sum()
+    # Set of the quantified accessions, looked up for every protein of the database
+    proteins = {
+        protein
+        for protein_group in res[PROTEIN_NAME].unique()
+        for protein in protein_group.split(";")
+    }
 
     # calculate the molecular weight of quantified proteins
     mw_dict = dict()
@@ -120,120 +161,69 @@ def tpa_compute(
 
     res = res[res[PROTEIN_NAME].isin(mw_dict.keys())]
 
-    # calculate TPA for every protein group
-    def get_protein_group_mw(group: str) -> float:
-        mw_list = [mw_dict[i] for i in group.split(";")]
-        return sum(mw_list)
-
-    res["MolecularWeight"] = res.apply(
-        lambda x: get_protein_group_mw(x[PROTEIN_NAME]), axis=1
-    )
+    # calculate TPA for every protein group, the weight is computed once per group
+    protein_group_mw = {
+        group: sum(mw_dict[i] for i in group.split(";"))
+        for group in res[PROTEIN_NAME].unique()
+    }
+    res["MolecularWeight"] = res[PROTEIN_NAME].map(protein_group_mw).astype("float64")
     res["MolecularWeight"] = res["MolecularWeight"].fillna(1)
     res["MolecularWeight"] = res["MolecularWeight"].replace(0, 1)
-    res["TPA"] = res[NORM_INTENSITY] / res["MolecularWeight"]
-    # Print the distribution of the protein TPA values
-    if verbose:
-        plot_width = len(set(res[SAMPLE_ID])) * 0.5 + 10
-        pdf = PdfPages(qc_report)
-        density = plot_distributions(
-            res, "TPA", SAMPLE_ID, log2=True, width=plot_width, title="TPA Distribution"
-        )
-        plt.show()
-        pdf.savefig(density)
-        box = plot_box_plot(
-            res,
-            "TPA",
-            SAMPLE_ID,
-            log2=True,
-            width=plot_width,
-            title="TPA Distribution",
-            violin=False,
-        )
-        plt.show()
-        pdf.savefig(box)
-
+    res["TPA"] = res[NORM_INTENSITY].to_numpy() / res["MolecularWeight"].to_numpy()
     # calculate protein weight(ng) and concentration(nM)
     if ruler:
         avogadro = 6.02214129e23
         average_base_pair_mass = 617.96  # 615.8771
 
-        organism = organism.lower()
-        histone_df = pd.read_json(
-            open(os.path.split(__file__)[0] + "../data/histones.json", "rb")
-        ).T
-        target_histones = histone_df[histone_df["name"] == organism.lower()]
-        genome_size = target_histones["genome_size"].values[0]
-        histones_list = target_histones["histone_entries"].values[0]
+        genome_size, histones_list = get_organism_histones(organism)
         dna_mass = ploidy * genome_size * average_base_pair_mass / avogadro
 
-        def calculate(protein_intensity, histone_intensity, mw):
-            copy = (protein_intensity / histone_intensity) * dna_mass * avogadro / mw
-            # The number of moles is equal to the number of particles divided by Avogadro's constant
-            moles = copy * 1e9 / avogadro  # unit nmol
-            weight = moles * mw  # unit ng
-            return tuple([copy, moles, weight])
-
-        def proteomic_ruler(df):
-            histone_intensity = df[df[PROTEIN_NAME].isin(histones_list)][
-                NORM_INTENSITY
-            ].sum()
-            histone_intensity = histone_intensity if histone_intensity > 0 else 1
-            df[["Copy", "Moles[nmol]", "Weight[ng]"]] = df.apply(
-                lambda x: calculate(
-                    x[NORM_INTENSITY], histone_intensity, x["MolecularWeight"]
-                ),
-                axis=1,
-                result_type="expand",
-            )
-            volume = df["Weight[ng]"].sum() * 1e-9 / cpc  # unit L
-            df["Concentration[nM]"] = df["Moles[nmol]"] / volume  # unit nM
-            return df
-
-        res = res.groupby([CONDITION]).apply(proteomic_ruler)
-
-        if verbose:
-            density = plot_distributions(
-                res,
-                "Copy",
-                SAMPLE_ID,
-                width=plot_width,
-                log2=True,
-                title="Copy numbers Distribution",
-            )
-            plt.show()
-            pdf.savefig(density)
-            box = plot_box_plot(
-                res,
-                "Copy",
-                SAMPLE_ID,
-                width=plot_width,
-                log2=True,
-                title="Copy numbers Distribution",
-                violin=False,
-            )
-            plt.show()
-            pdf.savefig(box)
-
-            density = plot_distributions(
-                res,
-                "Concentration[nM]",
-                SAMPLE_ID,
-                width=plot_width,
-                log2=True,
-                title="Concentration[nM] Distribution",
-            )
-            plt.show()
-            pdf.savefig(density)
-            box = plot_box_plot(
-                res,
-                "Concentration[nM]",
-                SAMPLE_ID,
-                width=plot_width,
-                log2=True,
-                title="Concentration[nM] Distribution",
-                violin=False,
+        # The histone intensity and the total weight of every condition are broadcast
+        # to its proteins with grouped transforms.
+        # The arithmetic runs on plain NumPy arrays and the columns are assigned at the end.
+        histone_intensity = (
+            res[NORM_INTENSITY]
+            .where(res[PROTEIN_NAME].isin(histones_list), 0)
+            .groupby(res[CONDITION], observed=True)
+            .transform("sum")
+            .to_numpy()
+        )
+        histone_intensity = np.where(histone_intensity > 0, histone_intensity, 1)
+        protein_intensity = res[NORM_INTENSITY].to_numpy()
+        mw = res["MolecularWeight"].to_numpy()
+        copy = (protein_intensity / histone_intensity) * dna_mass * avogadro / mw
+        # The number of moles is equal to the number of particles divided by Avogadro's constant
+        moles = copy * 1e9 / avogadro  # unit nmol
+        weight = moles * mw  # unit ng
+        volume = (
+            pd.Series(weight, index=res.index)
+            .groupby(res[CONDITION], observed=True)
+            .transform("sum")
+            .to_numpy()
+            * 1e-9
+            / cpc
+        )  # unit L
+        res["Copy"] = copy
+        res["Moles[nmol]"] = moles
+        res["Weight[ng]"] = weight
+        res["Concentration[nM]"] = moles / volume  # unit nM
+
+    # Print the distribution of the protein TPA values, copy numbers and concentrations,
+    # the report is drawn in a background thread while the results are written
+    fields = ["TPA"]
+    titles = ["TPA Distribution"]
+    if ruler:
+        fields += ["Copy", "Concentration[nM]"]
+        titles += ["Copy numbers Distribution", "Concentration[nM] Distribution"]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        report = (
+            executor.submit(
+                write_distribution_report, qc_report, res.copy(), fields, titles, SAMPLE_ID
             )
-            plt.show()
-            pdf.savefig(box)
-            pdf.close()
-        res.to_csv(output, index=False)
+            if verbose
+            else None
+        )
+        if ruler:
+            write_csv(res, output)
+        if report is not None:
+            report.result()
@@ -65,6 +65,11 @@ from ibaqpy.ibaq.peptide_normalization import peptide_normalization
     help="Save normalized peptides to parquet",
     is_flag=True,
 )
+@click.option(
+    "--workers",
+    help="Number of processes used to normalize the samples in parallel",
+    default=1,
+)
 @click.pass_context
 def features2parquet(
     ctx,
@@ -81,6 +86,7 @@ def features2parquet(
     pnmethod: str,
     log2: bool,
     save_parquet: bool,
+    workers: int,
 ) -> None:
     """
     Convert features to parquet file.
@@ -98,6 +104,7 @@ def features2parquet(
     :param pnmethod: Peptide normalization method used to normalize peptides intensities for all samples (options:globalMedian,conditionMedian)
     :param log2: Log2 transformation of peptide intensity values before normalization
     :param save_parquet: Save normalized peptides to parquet
+    :param workers: Number of processes used to normalize the samples in parallel
     """
 
     peptide_normalization(
@@ -114,4 +121,5 @@ def features2parquet(
         pnmethod=pnmethod,
         log2=log2,
         save_parquet=save_parquet,
+        workers=workers,
     )
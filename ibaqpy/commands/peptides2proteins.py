@@ -48,6 +48,11 @@ from ibaqpy.ibaq.compute_ibaq import ibaq_compute
     help="PDF file to store multiple QC images",
     default="IBAQ-QCprofile.pdf",
 )
+@click.option(
+    "--workers",
+    help="Number of processes used to digest the proteins in parallel",
+    default=1,
+)
 @click.pass_context
 def peptides2proteins(
     click_context,
@@ -60,6 +65,7 @@ def peptides2proteins(
     output: str,
     verbose: bool,
     qc_report: str,
+    workers: int,
 ) -> None:
     """
     This command computes the IBAQ values for a file output of peptides with the format described in
@@ -74,6 +80,7 @@ def peptides2proteins(
     :param output: output format containing the ibaq values.
     :param verbose: Print addition information.
     :param qc_report: PDF file to store multiple QC images.
+    :param workers: Number of processes used to digest the proteins in parallel.
     :return:
     """
     ibaq_compute(
@@ -86,4 +93,5 @@ def peptides2proteins(
         output=output,
         verbose=verbose,
         qc_report=qc_report,
+        workers=workers,
     )
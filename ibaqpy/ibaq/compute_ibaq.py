@@ -1,8 +1,9 @@
-import math
-import matplotlib.pyplot as plt
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
-from matplotlib.backends.backend_pdf import PdfPages
-from pandas import DataFrame, Series
+from pandas import DataFrame
 from pyopenms import *
 
 from ibaqpy.ibaq.ibaqpy_commons import (
@@ -12,18 +13,14 @@ from ibaqpy.ibaq.ibaqpy_commons import (
     IBAQ_NORMALIZED,
     IBAQ_PPB,
     NORM_INTENSITY,
+    PEPTIDES_DTYPES,
     PROTEIN_NAME,
     SAMPLE_ID,
-    plot_box_plot,
-    plot_distributions,
     get_accession,
+    write_csv,
+    write_distribution_report,
 )
 
-def normalize(group):
-    group[IBAQ_NORMALIZED] = group[IBAQ] / group[IBAQ].sum()
-    return group
-
-
 def normalize_ibaq(res: DataFrame) -> DataFrame:
     """
     Normalize the ibaq values using the total ibaq of the sample. The resulted
@@ -33,19 +30,46 @@ def normalize_ibaq(res: DataFrame) -> DataFrame:
     :return:
     """
 
-    res = res.groupby([SAMPLE_ID, CONDITION]).apply(normalize)
+    res[IBAQ_NORMALIZED] = res[IBAQ] / res.groupby(
+        [SAMPLE_ID, CONDITION], observed=True
+    )[IBAQ].transform("sum")
+    normalized = res[IBAQ_NORMALIZED].to_numpy()
+    positive = normalized > 0
 
     # Normalization method used by Proteomics DB 10 + log10(ibaq/sum(ibaq))
-    res[IBAQ_LOG] = res[IBAQ_NORMALIZED].apply(
-        lambda x: (math.log10(x) + 10) if x > 0 else 0
-    )
+    ibaq_log = np.zeros_like(normalized)
+    np.log10(normalized, out=ibaq_log, where=positive)
+    np.add(ibaq_log, 10, out=ibaq_log, where=positive)
+    res[IBAQ_LOG] = ibaq_log
 
     # Normalization used by PRIDE Team (no log transformation) (ibaq/total_ibaq) * 100'000'000
-    res[IBAQ_PPB] = res[IBAQ_NORMALIZED].apply(lambda x: x * 100000000)
+    res[IBAQ_PPB] = normalized * 100000000
 
     return res
 
 
+def count_unique_peptides(
+    sequences: list, enzyme: str, min_aa: int, max_aa: int
+) -> list:
+    """
+    Count the unique peptides of the in-silico digestion of every protein sequence.
+    :param sequences: Protein sequences to digest.
+    :param enzyme: Enzyme used to digest the protein sample.
+    :param min_aa: Minimum number of amino acids to consider a peptide.
+    :param max_aa: Maximum number of amino acids to consider a peptide.
+    :return: Number of unique peptides of every sequence.
+    """
+    digestor = ProteaseDigestion()
+    digestor.setEnzyme(enzyme)
+    # The digest list is reused, pyopenms replaces its content on every call
+    digest = list()  # type: list[str]
+    counts = list()
+    for sequence in sequences:
+        digestor.digest(AASequence.fromString(sequence), digest, min_aa, max_aa)
+        counts.append(len(set(digest)))
+    return counts
+
+
 def ibaq_compute(
     fasta: str,
     peptides: str,
@@ -56,6 +80,7 @@ def ibaq_compute(
     output: str,
     verbose: bool,
     qc_report: str,
+    workers: int = 1,
 ) -> None:
     """
     This command computes the IBAQ values for a file output of peptides with the format described in
@@ -69,6 +94,7 @@ def ibaq_compute(
     :param output: output format containing the ibaq values.
     :param verbose: Print addition information.
     :param qc_report: PDF file to store multiple QC images.
+    :param workers: Number of processes used to digest the proteins.
     :return:
     """
     if peptides is None or fasta is None:
@@ -78,46 +104,82 @@ def ibaq_compute(
     protein_accessions = list()
     FASTAFile().load(fasta, fasta_proteins)
     uniquepepcounts = dict()  # type: dict[str, int]
-    digestor = ProteaseDigestion()
-    digestor.setEnzyme(enzyme)
 
-    def get_average_nr_peptides_unique_bygroup(pdrow: Series) -> Series:
+    def get_average_nr_peptides_unique_bygroup(protein_group: str) -> float:
         """
-        Get the average intensity for protein groups
-        :param pdrow: peptide row
-        :return: average intensity
+        Get the average number of unique peptides of the proteins in a group
+        :param protein_group: protein group
+        :return: average number of unique peptides
         """
-        nonlocal map_size
-        proteins = pdrow.name[0].split(";")
+        proteins = protein_group.split(";")
         summ = 0
         for prot in proteins:
             summ += uniquepepcounts[prot]
         if len(proteins) > 0 and summ > 0:
-            return pdrow.NormIntensity / map_size[pdrow.name] / (summ / len(proteins))
+            return summ / len(proteins)
         # If there is no protein in the group, return np nan
         return np.nan  # type: ignore
 
+    data = pd.read_csv(
+        peptides,
+        sep=",",
+        engine="pyarrow",
+        usecols=[PROTEIN_NAME, SAMPLE_ID, CONDITION, NORM_INTENSITY],
+        dtype=PEPTIDES_DTYPES,
+    )
+    # Only the proteins quantified in the peptide file need to be digested
+    quantified_proteins = {
+        protein
+        for protein_group in data[PROTEIN_NAME].dropna().unique()
+        for protein in protein_group.split(";")
+    }
+
+    quantified_sequences = dict()  # type: dict[str, str]
     for entry in fasta_proteins:
-        digest = list()  # type: list[str]
-        digestor.digest(AASequence().fromString(entry.sequence), digest, min_aa, max_aa)
-        digestuniq = set(digest)
         # TODO: Try to get protein accessions from multiple databases.
         protein_name = get_accession(entry.identifier)
-        uniquepepcounts[protein_name] = len(digestuniq)
         protein_accessions.append(protein_name)
+        if protein_name in quantified_proteins:
+            quantified_sequences[protein_name] = entry.sequence
 
-    data = pd.read_csv(peptides, sep=",")
-    data = data[data[PROTEIN_NAME].isin(protein_accessions)]
+    # The sequences are digested in one chunk per worker process when requested
+    sequences = list(quantified_sequences.values())
+    digest = functools.partial(
+        count_unique_peptides, enzyme=enzyme, min_aa=min_aa, max_aa=max_aa
+    )
+    if workers > 1:
+        chunk_size = max(1, -(-len(sequences) // workers))
+        chunks = [
+            sequences[i : i + chunk_size] for i in range(0, len(sequences), chunk_size)
+        ]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            counts = [count for chunk in executor.map(digest, chunks) for count in chunk]
+    else:
+        counts = digest(sequences)
+    uniquepepcounts.update(zip(quantified_sequences, counts))
+
+    # Match the few distinct protein groups against the database instead of every row
+    fasta_accessions = set(protein_accessions)
+    data = data[
+        data[PROTEIN_NAME].isin(
+            [group for group in data[PROTEIN_NAME].unique() if group in fasta_accessions]
+        )
+    ]
     print(data.head())
+    grouped = data.groupby([PROTEIN_NAME, SAMPLE_ID, CONDITION], observed=True)[
+        NORM_INTENSITY
+    ]
     # next line assumes unique peptides only (at least per indistinguishable group)
-    map_size = data.groupby(["ProteinName", "SampleID", "Condition"]).size().to_dict()
-    res = pd.DataFrame(
-        data.groupby([PROTEIN_NAME, SAMPLE_ID, CONDITION])[NORM_INTENSITY].sum()
-    ).apply(get_average_nr_peptides_unique_bygroup, 1)
-    res = res.sort_values(ascending=False)
-    res = res.to_frame()
-    res = res.reset_index()
-    res = res.rename(columns={0: IBAQ})
+    res = grouped.sum() / grouped.size()
+    # The average is computed once per protein group and mapped to all its samples
+    protein_groups = res.index.get_level_values(PROTEIN_NAME)
+    average_nr_peptides = {
+        protein_group: get_average_nr_peptides_unique_bygroup(protein_group)
+        for protein_group in protein_groups.unique()
+    }
+    res = res / protein_groups.map(average_nr_peptides).astype("float64")
+    # The index is materialized as columns only once, naming the values on the way
+    res = res.sort_values(ascending=False).reset_index(name=IBAQ)
 
     if normalize:
         res = normalize_ibaq(res)
@@ -129,35 +191,25 @@ def ibaq_compute(
         res = res.dropna(subset=[IBAQ])
         plot_column = IBAQ
 
-    # Print the distribution of the protein IBAQ values
-    if verbose:
-        plot_width = len(set(res["SampleID"])) * 0.5 + 10
-        pdf = PdfPages(qc_report)
-        density = plot_distributions(
-            res,
-            plot_column,
-            SAMPLE_ID,
-            log2=True,
-            width=plot_width,
-            title="IBAQ Distribution",
-        )
-        plt.show()
-        pdf.savefig(density)
-        box = plot_box_plot(
-            res,
-            plot_column,
-            SAMPLE_ID,
-            log2=True,
-            width=plot_width,
-            title="IBAQ Distribution",
-            violin=False,
-        )
-        plt.show()
-        pdf.savefig(box)
-        pdf.close()
-
     # # For absolute expression the relation is one sample + one condition
     # condition = data[CONDITION].unique()[0]
     # res[CONDITION] = condition.lower()
 
-    res.to_csv(output, index=False)
+    # Print the distribution of the protein IBAQ values, the report is drawn in a
+    # background thread while the results are written
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        report = (
+            executor.submit(
+                write_distribution_report,
+                qc_report,
+                res.copy(),
+                [plot_column],
+                ["IBAQ Distribution"],
+                SAMPLE_ID,
+            )
+            if verbose
+            else None
+        )
+        write_csv(res, output)
+        if report is not None:
+            report.result()
@@ -2,8 +2,12 @@ import os
 import matplotlib
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import seaborn as sns
 from matplotlib import pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
 
 PARQUET_COLUMNS = [
     "protein_accessions",
@@ -51,6 +55,15 @@ IBAQ_NORMALIZED = "IbaqNorm"
 IBAQ_LOG = "IbaqLog"
 IBAQ_PPB = "IbaqPpb"
 
+# Column types of the normalized peptide intensities read by the protein quantification,
+# the repeated keys are read as categoricals so they are grouped by their integer codes.
+PEPTIDES_DTYPES = {
+    PROTEIN_NAME: "category",
+    SAMPLE_ID: "category",
+    CONDITION: "category",
+    NORM_INTENSITY: "float64",
+}
+
 parquet_map = {
     "protein_accessions": PROTEIN_NAME,
     "peptidoform": PEPTIDE_SEQUENCE,
@@ -137,19 +150,63 @@ ITRAQ8plex = {
 }
 
 
+def map_channel(channels: pd.Series, plex: dict) -> pd.Series:
+    """
+    Map the channel labels (e.g. TMT126) to the channel numbers of a plex dictionary.
+    The labels are factorized once against the plex categories instead of looked up
+    one by one.
+    :param channels: Channel labels
+    :param plex: Plex dictionary (e.g. TMT16plex)
+    :return: Channel numbers, missing for labels not in the plex
+    """
+    codes = pd.Categorical(channels, categories=list(plex.keys())).codes
+    numbers = pd.array(list(plex.values()), dtype="Int16")
+    return pd.Series(numbers.take(codes, allow_fill=True), index=channels.index)
+
+
 def get_accession(identifier: str) -> str:
     """
     Get protein accession from the identifier  (e.g. sp|P12345|PROT_NAME)
     :param identifier: Protein identifier
     :return: Protein accession
     """
-    identifier_lst = identifier.split("|")
+    identifier_lst = identifier.split("|", 2)
     if len(identifier_lst) == 1:
         return identifier_lst[0]
     else:
         return identifier_lst[1]
 
 
+def log2_positive(values: pd.Series) -> np.ndarray:
+    """
+    Log2 transform the values, non-positive values are returned as NaN instead of -inf
+    :param values: Values to transform
+    :return: Log2 values
+    """
+    values = values.to_numpy(dtype=float)
+    return np.log2(values, out=np.full_like(values, np.nan), where=values > 0)
+
+
+def write_csv(dataset: pd.DataFrame, output: str) -> None:
+    """
+    Write a DataFrame without its index as CSV using the multi-threaded pyarrow writer
+    :param dataset: DataFrame to write
+    :param output: Path of the CSV file
+    :return:
+    """
+    table = pa.Table.from_pandas(dataset, preserve_index=False)
+    # Categorical columns are written with their values instead of dictionary arrays
+    schema = pa.schema(
+        [
+            pa.field(field.name, field.type.value_type)
+            if pa.types.is_dictionary(field.type)
+            else field
+            for field in table.schema
+        ]
+    )
+    pa_csv.write_csv(table.cast(schema), output)
+
+
 def plot_distributions(
     dataset: pd.DataFrame,
     field: str,
@@ -157,6 +214,7 @@ def plot_distributions(
     title: str = "",
     log2: bool = True,
     width: float = 10,
+    ax: matplotlib.axes.Axes = None,
 ) -> matplotlib.pyplot:
     """
     Print the quantile plot for the dataset
@@ -166,20 +224,28 @@ def plot_distributions(
     :param title: Title of the box plot
     :param log2: Log the intensity values
     :param width: size of the plot
+    :param ax: Axes to draw on, a new figure is created if None
     :return:
     """
-    pd.set_option("mode.chained_assignment", None)
     normalize = dataset[[field, class_field]].reset_index(drop=True)
     if log2:
-        normalize[field] = np.log2(normalize[field])
+        normalize[field] = log2_positive(normalize[field])
     normalize.dropna(subset=[field], inplace=True)
-    data_wide = normalize.pivot(columns=class_field, values=field)
-    # plotting multiple density plot
-    data_wide.plot.kde(figsize=(width, 8), linewidth=2, legend=False)
-    plt.title(title)
-    pd.set_option("mode.chained_assignment", "warn")
+    if ax is None:
+        plt.figure(figsize=(width, 8))
+    # plotting multiple density plot, one per class, from the long format data
+    chart = sns.kdeplot(
+        data=normalize,
+        x=field,
+        hue=class_field,
+        common_norm=False,
+        linewidth=2,
+        legend=False,
+        ax=ax,
+    )
+    chart.set(title=title)
 
-    return plt.gcf()
+    return chart.figure
 
 
 def plot_box_plot(
@@ -191,6 +257,7 @@ def plot_box_plot(
     rotation: int = 30,
     title: str = "",
     violin: bool = False,
+    ax: matplotlib.axes.Axes = None,
 ) -> matplotlib.pyplot:
     """
     Plot a box plot of two values field and classes field
@@ -202,14 +269,14 @@ def plot_box_plot(
     :param width: size of the plot
     :param rotation: rotation of the x-axis
     :param title: Title of the box plot
+    :param ax: Axes to draw on, a new figure is created if None
     :return:
     """
-    pd.set_option("mode.chained_assignment", None)
-    normalized = dataset[[field, class_field]]
-    np.seterr(divide="ignore")
-    plt.figure(figsize=(width, 14))
+    normalized = dataset[[field, class_field]].copy()
+    if ax is None:
+        plt.figure(figsize=(width, 14))
     if log2:
-        normalized[field] = np.log2(normalized[field])
+        normalized[field] = log2_positive(normalized[field])
 
     if violin:
         chart = sns.violinplot(
@@ -218,6 +285,7 @@ def plot_box_plot(
             data=normalized,
             boxprops=dict(alpha=0.3),
             palette="muted",
+            ax=ax,
         )
     else:
         chart = sns.boxplot(
@@ -226,13 +294,65 @@ def plot_box_plot(
             data=normalized,
             boxprops=dict(alpha=0.3),
             palette="muted",
+            ax=ax,
         )
 
     chart.set(title=title)
     chart.set_xticklabels(chart.get_xticklabels(), rotation=rotation, ha="right")
-    pd.set_option("mode.chained_assignment", "warn")
 
-    return plt.gcf()
+    return chart.figure
+
+
+def plot_distribution_pages(
+    pdf: PdfPages,
+    dataset: pd.DataFrame,
+    fields: list,
+    titles: list,
+    class_field: str,
+    width: float = 10,
+) -> None:
+    """
+    Save the density and box plot of every field as one page of a PDF report
+    :param pdf: PDF report the pages are saved to
+    :param dataset: DataFrame with the values to plot
+    :param fields: Fields to plot, one page per field
+    :param titles: Title of every page
+    :param class_field: Field to group the values into classes
+    :param width: size of the plot
+    :return:
+    """
+    # Select and log the columns once for all the pages
+    normalized = dataset[[class_field, *fields]].reset_index(drop=True)
+    for field in fields:
+        normalized[field] = log2_positive(normalized[field])
+    for field, title in zip(fields, titles):
+        # Figures are built without pyplot, so the pages can be drawn outside the main thread
+        fig = Figure(figsize=(width, 22))
+        density_ax, box_ax = fig.subplots(2, 1, gridspec_kw={"height_ratios": [8, 14]})
+        plot_distributions(
+            normalized, field, class_field, title=title, log2=False, ax=density_ax
+        )
+        plot_box_plot(
+            normalized, field, class_field, title=title, log2=False, ax=box_ax
+        )
+        pdf.savefig(fig)
+
+
+def write_distribution_report(
+    qc_report: str, dataset: pd.DataFrame, fields: list, titles: list, class_field: str
+) -> None:
+    """
+    Write the distribution pages of the fields to a PDF QC report
+    :param qc_report: PDF file to store the QC images
+    :param dataset: DataFrame with the values to plot
+    :param fields: Fields to plot, one page per field
+    :param titles: Title of every page
+    :param class_field: Field to group the values into classes
+    :return:
+    """
+    plot_width = dataset[class_field].nunique() * 0.5 + 10
+    with PdfPages(qc_report) as pdf:
+        plot_distribution_pages(pdf, dataset, fields, titles, class_field, plot_width)
 
 
 # Functions needed by Combiner
@@ -1,8 +1,15 @@
+import contextlib
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import os
 import re
 import numpy as np
 import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from ibaqpy.ibaq.normalization_methods import normalize_run
 
 from ibaqpy.ibaq.ibaqpy_commons import (
@@ -27,8 +34,25 @@ from ibaqpy.ibaq.ibaqpy_commons import (
     ITRAQ4plex,
     ITRAQ8plex,
     parquet_map,
+    map_channel,
 )
 
+MODIFICATION_PATTERN = re.compile(r"[\(\[].*?[\)\]]")
+CONTAMINANTS_ENTRAPMENTS_DECOYS = ("CONTAMINANT", "ENTRAP", "DECOY")
+# Columns written for the normalized peptides
+PEPTIDES_SCHEMA = pa.schema(
+    [
+        (PROTEIN_NAME, pa.string()),
+        (PEPTIDE_CANONICAL, pa.string()),
+        (SAMPLE_ID, pa.string()),
+        (BIOREPLICATE, pa.string()),
+        (CONDITION, pa.string()),
+        (NORM_INTENSITY, pa.float32()),
+    ]
+)
+# Channels that only exist in TMT 16plex
+TMT16PLEX_LABELS = frozenset({"TMT132N", "TMT132C", "TMT133N", "TMT133C", "TMT134N"})
+
 
 def parse_uniprot_accession(uniprot_id: str) -> str:
     """
@@ -46,13 +70,27 @@ def parse_uniprot_accession(uniprot_id: str) -> str:
     return ";".join(result_uniprot_list)
 
 
+def parse_uniprot_accession_series(uniprot_ids: pd.Series) -> pd.Series:
+    """
+    Vectorized version of parse_uniprot_accession for a column of protein groups.
+    :param uniprot_ids: uniprot ids, one protein group per row
+    :return: uniprot accessions
+    """
+    # The same protein groups are repeated across many features, parse each one once.
+    accessions = {
+        protein_group: parse_uniprot_accession(protein_group)
+        for protein_group in uniprot_ids.unique()
+    }
+    return uniprot_ids.map(accessions)
+
+
 def get_canonical_peptide(peptide_sequence: str) -> str:
     """
     This function returns a peptide sequence without the modification information
     :param peptide_sequence: peptide sequence with mods
     :return: peptide sequence
     """
-    clean_peptide = re.sub("[\(\[].*?[\)\]]", "", peptide_sequence)
+    clean_peptide = MODIFICATION_PATTERN.sub("", peptide_sequence)
     clean_peptide = clean_peptide.replace(".", "").replace("-", "")
     return clean_peptide
 
@@ -101,17 +139,11 @@ def get_label(labels: list) -> (str, dict):
     :return: Tuple contains label type and choice dict.
     """
     choice = None
+    joined_labels = ",".join(labels)
     if len(labels) == 1:
         label = "LFQ"
-    elif "TMT" in ",".join(labels) or "tmt" in ",".join(labels):
-        if (
-                len(labels) > 11
-                or "TMT134N" in labels
-                or "TMT133C" in labels
-                or "TMT133N" in labels
-                or "TMT132C" in labels
-                or "TMT132N" in labels
-        ):
+    elif "TMT" in joined_labels or "tmt" in joined_labels:
+        if len(labels) > 11 or not TMT16PLEX_LABELS.isdisjoint(labels):
             choice = TMT16plex
         elif len(labels) == 11 or "TMT131C" in labels:
             choice = TMT11plex
@@ -120,7 +152,7 @@ def get_label(labels: list) -> (str, dict):
         else:
             choice = TMT6plex
         label = "TMT"
-    elif "ITRAQ" in ",".join(labels) or "itraq" in ",".join(labels):
+    elif "ITRAQ" in joined_labels or "itraq" in joined_labels:
         if len(labels) > 4:
             choice = ITRAQ8plex
         else:
@@ -131,6 +163,29 @@ def get_label(labels: list) -> (str, dict):
     return label, choice
 
 
+def remove_protein_groups_by_pattern(
+        dataset: pd.DataFrame, pattern, protein_field=PROTEIN_NAME
+) -> pd.DataFrame:
+    """
+    Remove the rows whose protein group matches the given pattern. The same protein group
+    is shared by many features, so the pattern is only evaluated once per distinct group.
+    :param dataset: Peptide intensity DataFrame
+    :param pattern: Compiled regex, or a tuple of plain substrings, with the proteins to remove
+    :param protein_field: protein field
+    :return: dataset with the filtered proteins
+    """
+    protein_groups = pd.Series(dataset[protein_field].unique())
+    if isinstance(pattern, re.Pattern):
+        matches = protein_groups.str.contains(pattern, na=False)
+    else:
+        # Plain substrings do not need the regex engine
+        matches = np.logical_or.reduce(
+            [protein_groups.str.contains(word, regex=False, na=False) for word in pattern]
+        )
+    matched_groups = protein_groups[matches]
+    return dataset[~dataset[protein_field].isin(matched_groups)]
+
+
 def remove_contaminants_entrapments_decoys(
         dataset: pd.DataFrame, protein_field=PROTEIN_NAME
 ) -> pd.DataFrame:
@@ -141,12 +196,24 @@ def remove_contaminants_entrapments_decoys(
     :param protein_field: protein field
     :return: dataset with the filtered proteins
     """
-    contaminants = []
-    contaminants.append("CONTAMINANT")
-    contaminants.append("ENTRAP")
-    contaminants.append("DECOY")
-    cregex = "|".join(contaminants)
-    return dataset[~dataset[protein_field].str.contains(cregex)]
+    return remove_protein_groups_by_pattern(
+        dataset, CONTAMINANTS_ENTRAPMENTS_DECOYS, protein_field
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def load_protein_ids_pattern(protein_file: str, modified_time: float) -> re.Pattern:
+    """
+    Read a file with one protein id per line and compile it into a single regex. The
+    result is cached per file and modification time, so the file is read only once
+    when the same ids are removed from every sample.
+    :param protein_file: File with the protein ids
+    :param modified_time: Modification time of the file, part of the cache key
+    :return: Compiled regex matching any of the protein ids
+    """
+    with open(protein_file, "r") as contaminants_reader:
+        contaminants = [line.strip() for line in contaminants_reader if line.strip()]
+    return re.compile("|".join(re.escape(cont) for cont in contaminants))
 
 
 def remove_protein_by_ids(
@@ -160,11 +227,8 @@ def remove_protein_by_ids(
     :param protein_field: protein field
     :return: dataset with the filtered proteins
     """
-    contaminants_reader = open(protein_file, "r")
-    contaminants = contaminants_reader.read().split("\n")
-    contaminants = [cont for cont in contaminants if cont.strip()]
-    cregex = "|".join(contaminants)
-    return dataset[~dataset[protein_field].str.contains(cregex)]
+    cregex = load_protein_ids_pattern(protein_file, os.path.getmtime(protein_file))
+    return remove_protein_groups_by_pattern(dataset, cregex, protein_field)
 
 
 def parquet_common_process(
@@ -179,11 +243,10 @@ def parquet_common_process(
     """
 
     data_df = data_df.rename(columns=parquet_map)
-    data_df[PROTEIN_NAME] = data_df.apply(lambda x: ";".join(x[PROTEIN_NAME]), axis=1)
     if label == "LFQ":
         data_df.drop(CHANNEL, inplace=True, axis=1)
     else:
-        data_df[CHANNEL] = data_df[CHANNEL].map(choice)
+        data_df[CHANNEL] = map_channel(data_df[CHANNEL], choice)
 
     return data_df
 
@@ -194,14 +257,14 @@ def data_common_process(data_df: pd.DataFrame, min_aa: int) -> pd.DataFrame:
     data_df = data_df[data_df["Condition"] != "Empty"]
 
     # Filter peptides with less amino acids than min_aa (default: 7)
-    data_df.loc[:,'len'] = data_df[PEPTIDE_CANONICAL].apply(len)
-    data_df = data_df[data_df['len']>=min_aa]
-    data_df.drop(['len'],inplace=True,axis=1)
-    data_df[PROTEIN_NAME] = data_df[PROTEIN_NAME].apply(parse_uniprot_accession)
+    data_df = data_df[data_df[PEPTIDE_CANONICAL].str.len() >= min_aa]
+    data_df[PROTEIN_NAME] = parse_uniprot_accession_series(data_df[PROTEIN_NAME])
     if FRACTION not in data_df.columns:
         data_df[FRACTION] = 1
-    data_df[TECHREPLICATE] = data_df[RUN].str.split("_").str.get(1)
-    data_df[TECHREPLICATE] = data_df[TECHREPLICATE].astype("int")
+    # Runs are named sample_techreplicate_fraction, only split up to the second field
+    data_df[TECHREPLICATE] = pd.to_numeric(
+        data_df[RUN].str.split("_", n=2).str.get(1), downcast="integer"
+    )
     data_df = data_df[
         [
             PROTEIN_NAME,
@@ -216,8 +279,14 @@ def data_common_process(data_df: pd.DataFrame, min_aa: int) -> pd.DataFrame:
             SAMPLE_ID,
         ]
     ]
+    # Grouping keys are kept as categoricals for the rest of the pipeline so that
+    # groupby hashes integer codes instead of strings.
+    data_df[PROTEIN_NAME] = pd.Categorical(data_df[PROTEIN_NAME])
+    data_df[PEPTIDE_CANONICAL] = pd.Categorical(data_df[PEPTIDE_CANONICAL])
     data_df[CONDITION] = pd.Categorical(data_df[CONDITION])
     data_df[SAMPLE_ID] = pd.Categorical(data_df[SAMPLE_ID])
+    # Single precision is enough for intensities and halves the memory of the hot column.
+    data_df[INTENSITY] = data_df[INTENSITY].astype("float32")
 
     return data_df
 
@@ -228,7 +297,6 @@ def merge_fractions(dataset: pd.DataFrame) -> pd.DataFrame:
     :param dataset: dataset including all properties
     :return:
     """
-    dataset.dropna(subset=[NORM_INTENSITY], inplace=True)
     dataset = dataset.groupby(
         [
             PROTEIN_NAME,
@@ -241,8 +309,8 @@ def merge_fractions(dataset: pd.DataFrame) -> pd.DataFrame:
             SAMPLE_ID,
         ],
         observed=True,
+        as_index=False,
     ).agg({NORM_INTENSITY: "max"})
-    dataset.reset_index(inplace=True)
     return dataset
 
 
@@ -256,14 +324,15 @@ def get_peptidoform_normalize_intensities(
     :param higher_intensity: select based on normalize intensity, if false based on best scored peptide
     :return:
     """
-    dataset.dropna(subset=[NORM_INTENSITY], inplace=True)
+    # Feature normalization can leave missing intensities, later steps rely on this filter
+    dataset = dataset[dataset[NORM_INTENSITY].notna()]
     if higher_intensity:
-        dataset = dataset.loc[
-            dataset.groupby(
-                [PEPTIDE_SEQUENCE, PEPTIDE_CHARGE, SAMPLE_ID, CONDITION, BIOREPLICATE],
-                observed=True,
-            )[NORM_INTENSITY].idxmax()
-        ]
+        # A stable descending sort keeps the first row among equal intensities, as idxmax
+        dataset = dataset.sort_values(
+            NORM_INTENSITY, ascending=False, kind="mergesort"
+        ).drop_duplicates(
+            subset=[PEPTIDE_SEQUENCE, PEPTIDE_CHARGE, SAMPLE_ID, CONDITION, BIOREPLICATE]
+        )
     # else:
     #     dataset = dataset.loc[
     #         dataset.groupby(
@@ -271,7 +340,6 @@ def get_peptidoform_normalize_intensities(
     #             observed=True,
     #         )[SEARCH_ENGINE].idxmax()
     #     ]
-    dataset.reset_index(drop=True, inplace=True)
     return dataset
 
 
@@ -281,26 +349,41 @@ def sum_peptidoform_intensities(dataset: pd.DataFrame) -> pd.DataFrame:
     :param dataset: Dataframe to be analyzed
     :return: dataframe with the intensities
     """
-    dataset.dropna(subset=[NORM_INTENSITY], inplace=True)
-    dataset = dataset[
-        [
-            PROTEIN_NAME,
-            PEPTIDE_CANONICAL,
-            SAMPLE_ID,
-            BIOREPLICATE,
-            CONDITION,
-            NORM_INTENSITY,
-        ]
-    ]
-    dataset.loc[:, "NormIntensity"] = dataset.groupby(
+    dataset = dataset.groupby(
         [PROTEIN_NAME, PEPTIDE_CANONICAL, SAMPLE_ID, BIOREPLICATE, CONDITION],
         observed=True,
-    )[NORM_INTENSITY].transform("sum")
-    dataset = dataset.drop_duplicates()
-    dataset.reset_index(inplace=True, drop=True)
+        sort=False,
+        as_index=False,
+    )[NORM_INTENSITY].sum()
     return dataset
 
 
+def to_arrow_table(dataset: pd.DataFrame) -> pa.Table:
+    """
+    Convert the normalized peptides of a sample to an Arrow table with the output
+    schema, so every sample appended to the same file has the same column types
+    and no schema has to be inferred per sample.
+    :param dataset: Peptide intensity DataFrame
+    :return: Arrow table
+    """
+    return pa.Table.from_pandas(
+        dataset, schema=PEPTIDES_SCHEMA, preserve_index=False, safe=False
+    )
+
+
+def arrow_string_types(arrow_type: pa.DataType):
+    """
+    Map Arrow string columns to pandas' pyarrow backed string dtype when converting
+    an Arrow table to pandas, so string columns stay in contiguous Arrow buffers and
+    pandas string methods run on Arrow compute kernels.
+    :param arrow_type: Arrow type of the column
+    :return: pandas dtype or None to use the default conversion
+    """
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return pd.StringDtype("pyarrow")
+    return None
+
+
 class Feature:
 
     def __init__(self, database_path: str):
@@ -327,94 +410,53 @@ class Feature:
         """Return peptides with low frequency"""
         f_table = self.parquet_db.sql(
             """
-                SELECT "sequence","protein_accessions",COUNT(DISTINCT sample_accession) as "count" from parquet_db
+                SELECT "sequence","protein_accessions"[1] as "accession" from parquet_db
+                WHERE "protein_accessions" IS NOT NULL
                 GROUP BY "sequence","protein_accessions"
-                """
+                HAVING COUNT(DISTINCT sample_accession) < {}
+                """.format(percentage * len(self.samples))
         ).df()
-        try:
-            f_table["protein_accessions"] = f_table["protein_accessions"].apply(
-                lambda x: x[0].split("|")[1]
-            )
-        except IndexError:
-            f_table["protein_accessions"] = f_table["protein_accessions"].apply(
-                lambda x: x[0]
-            )
-        except Exception as e:
-            print(e)
-            exit(
-                "Some errors occurred when parsing protein_accessions column in feature parquet!"
-            )
-        f_table.set_index(["sequence", "protein_accessions"], inplace=True)
-        f_table.drop(
-            f_table[f_table["count"] >= (percentage * len(self.samples))].index,
-            inplace=True,
-        )
-        f_table.reset_index(inplace=True)
-        return tuple(zip(f_table["protein_accessions"], f_table["sequence"]))
-
-    @staticmethod
-    def csv2parquet(csv):
-        parquet_path = os.path.splitext(csv)[0] + ".parquet"
-        duckdb.read_csv(csv).to_parquet(parquet_path)
-
-    @staticmethod
-    def get_label(labels: list) -> (str, dict):
-        """Return label type and choice dict according to labels list.
-
-        :param labels: Labels from SDRF.
-        :return: Tuple contains label type and choice dict.
-        """
-        choice = None
-        if len(labels) == 1 and (
-                "LABEL FREE" in ",".join(labels) or "label free" in ",".join(labels)
-        ):
-            label = "LFQ"
-        elif "TMT" in ",".join(labels) or "tmt" in ",".join(labels):
-            if (
-                    len(labels) > 11
-                    or "TMT134N" in labels
-                    or "TMT133C" in labels
-                    or "TMT133N" in labels
-                    or "TMT132C" in labels
-                    or "TMT132N" in labels
-            ):
-                choice = TMT16plex
-            elif len(labels) == 11 or "TMT131C" in labels:
-                choice = TMT11plex
-            elif len(labels) > 6:
-                choice = TMT10plex
-            else:
-                choice = TMT6plex
-            label = "TMT"
-        elif "ITRAQ" in ",".join(labels) or "itraq" in ",".join(labels):
-            if len(labels) > 4:
-                choice = ITRAQ8plex
-            else:
-                choice = ITRAQ4plex
-            label = "ITRAQ"
-        else:
-            exit("Warning: Only support label free, TMT and ITRAQ experiment!")
-        return label, choice
-
-    def get_report_from_database(self, samples: list, columns: list = None):
+        # Keep the accession of db|ACCESSION|NAME identifiers, other identifiers as they are
+        accessions = f_table["accession"]
+        accessions = accessions.str.split("|").str.get(1).fillna(accessions)
+        return tuple(zip(accessions, f_table["sequence"]))
+
+    def get_report_from_database(
+            self, samples: list, columns: list = None, where: str = None
+    ):
         """
         This function loads the report from the duckdb database for a group of ms_runs.
         :param columns: A list of columns
         :param samples: A list of samples
-        :return: The report
+        :param where: Optional SQL predicate applied by duckdb while scanning the features
+        :return: The report, with the protein accessions of each feature joined by ";"
         """
-        cols = ','.join(columns) if columns is not None else '*'
-        database = self.parquet_db.sql(
-            """SELECT {} FROM parquet_db WHERE sample_accession IN {}""".format(
-                cols, tuple(samples)
-            )
+        cols = ','.join(f'"{col}"' for col in columns) if columns is not None else '*'
+        predicate = f" AND ({where})" if where is not None else ""
+        # The samples are bound as a list parameter, so the query text does not depend on
+        # them and a single sample does not render as a one-element tuple.
+        database = self.parquet_db.execute(
+            """SELECT {} FROM parquet_db WHERE sample_accession = ANY($1){}""".format(
+                cols, predicate
+            ),
+            [list(samples)],
         )
-        report = database.df()
-        return report
+        report = database.fetch_arrow_table()
+        # Protein groups are joined by Arrow's list kernel, pandas would otherwise
+        # build one Python list per feature.
+        if "protein_accessions" in report.column_names:
+            report = report.set_column(
+                report.column_names.index("protein_accessions"),
+                "protein_accessions",
+                pc.binary_join(report["protein_accessions"], ";"),
+            )
+        return report.to_pandas(types_mapper=arrow_string_types)
 
-    def iter_samples(self, file_num: int = 20, columns: list = None):
+    def iter_samples(self, file_num: int = 20, columns: list = None, where: str = None):
         """
         :params file_num: The number of files being processed at the same time (default 20)
+        :params columns: A list of columns
+        :params where: Optional SQL predicate to filter the features
         :yield: _description_
         """
         ref_list = [
@@ -422,7 +464,7 @@ class Feature:
             for i in range(0, len(self.samples), file_num)
         ]
         for refs in ref_list:
-            batch_df = self.get_report_from_database(refs, columns)
+            batch_df = self.get_report_from_database(refs, columns, where)
             yield refs, batch_df
 
     def get_unique_samples(self):
@@ -447,27 +489,30 @@ class Feature:
         """
         return: A list of labels.
         """
-        unique = self.parquet_db.sql("SELECT DISTINCT run FROM parquet_db").df()
         try:
-            unique["run"] = unique["run"].str.split("_").str.get(1)
-            unique["run"] = unique["run"].astype("int")
-        except ValueError as e:
+            unique = self.parquet_db.sql(
+                """
+                SELECT CAST(split_part(run, '_', 2) AS INTEGER) AS tec
+                FROM (SELECT DISTINCT run FROM parquet_db)
+                """
+            ).fetchnumpy()
+        except duckdb.Error as e:
             print(e)
-            exit(
-                f"Some errors occurred when getting technical repetitions: {Exception}"
-            )
+            exit(f"Some errors occurred when getting technical repetitions: {e}")
 
-        return unique["run"].tolist()
+        return unique["tec"].tolist()
 
     def get_median_map(self):
-        med_map = {}
-        for _, batch_df in self.iter_samples(1000, ["sample_accession", "intensity"]):
-            meds = batch_df.groupby(["sample_accession"])["intensity"].median()
-            med_map.update(meds.to_dict())
-        global_med = np.median([med for med in med_map.values()])
-        for sample, med in med_map.items():
-            med_map[sample] = med / global_med
-        return med_map
+        """
+        return: A dict with the median intensity of every sample divided by the
+            median of all sample medians.
+        """
+        meds = self.parquet_db.sql(
+            """SELECT sample_accession, median(intensity) AS med FROM parquet_db
+            GROUP BY sample_accession"""
+        ).df()
+        global_med = meds["med"].median()
+        return dict(zip(meds["sample_accession"], meds["med"] / global_med))
 
     def get_report_condition_from_database(self, cons: list, columns: list = None):
         """
@@ -476,13 +521,12 @@ class Feature:
         :param cons: A list of conditions in
         :return: The report
         """
-        cols = ','.join(columns) if columns is not None else '*'
-        database = self.parquet_db.sql(
-            """SELECT {} FROM parquet_db WHERE condition IN {}""".format(
-                cols, tuple(cons)
-            )
+        cols = ','.join(f'"{col}"' for col in columns) if columns is not None else '*'
+        database = self.parquet_db.execute(
+            """SELECT {} FROM parquet_db WHERE condition = ANY($1)""".format(cols),
+            [list(cons)],
         )
-        report = database.df()
+        report = database.fetch_arrow_table().to_pandas(types_mapper=arrow_string_types)
         return report
 
     def iter_conditions(self, conditions: int = 10, columns: list = None):
@@ -503,21 +547,162 @@ class Feature:
         return unique["condition"].tolist()
 
     def get_median_map_to_condition(self):
+        """
+        return: A dict per condition with the median intensity of every sample divided
+            by the mean of the sample medians in that condition.
+        """
+        meds = self.parquet_db.sql(
+            """SELECT condition, sample_accession, median(intensity) AS med FROM parquet_db
+            GROUP BY condition, sample_accession"""
+        ).df()
+        meds["med"] = meds["med"] / meds.groupby("condition")["med"].transform("mean")
         med_map = {}
-        for cons, batch_df in self.iter_conditions(
-                1000, ["condition", "sample_accession", "intensity"]
-        ):
-            for con in cons:
-                meds = (
-                    batch_df[batch_df["condition"] == con]
-                    .groupby(["sample_accession"])["intensity"]
-                    .median()
-                )
-                meds = meds / meds.mean()
-                med_map[con] = meds.to_dict()
+        for con, con_meds in meds.groupby("condition", sort=False):
+            med_map[con] = dict(zip(con_meds["sample_accession"], con_meds["med"]))
         return med_map
 
 
+def process_sample(
+        sample: str,
+        dataset_df: pd.DataFrame,
+        label: str,
+        choice: dict,
+        min_aa: int,
+        min_unique: int,
+        remove_ids: str,
+        remove_decoy_contaminants: bool,
+        low_frequency_peptides: pd.MultiIndex,
+        skip_normalization: bool,
+        technical_repetitions: int,
+        nmethod: str,
+        pnmethod: str,
+        med_map: dict,
+        log2: bool,
+) -> pd.DataFrame:
+    """
+    Normalize the features of one sample into peptide intensities. Samples are
+    independent, so this can run in a worker process.
+    :param sample: Sample accession
+    :param dataset_df: Features of the sample
+    :param label: Label type of the experiment
+    :param choice: Choice dict for the label type
+    :param min_aa: Min amino acids
+    :param min_unique: Min of unique peptides
+    :param remove_ids: Remove features for the given proteins
+    :param remove_decoy_contaminants: Remove contaminants and entrapment
+    :param low_frequency_peptides: Index of low frequency (protein, peptide) pairs to remove,
+        None to keep them
+    :param skip_normalization: Skip normalization
+    :param technical_repetitions: Number of technical repetitions
+    :param nmethod: normalization method for features
+    :param pnmethod: peptide normalization method
+    :param med_map: Medians used by the peptide normalization
+    :param log2: log intensities for features before normalizing
+    :return: Normalized peptide intensities of the sample
+    """
+    # Perform data preprocessing on every sample
+    print(f"{str(sample).upper()}: Data preprocessing...")
+    # Step1: Parse the identifier of proteins and retain only unique peptides.
+    dataset_df = parquet_common_process(dataset_df, label, choice)
+    # Step2: Remove lines where intensity or study condition is empty.
+    # Step3: Filter peptides with less amino acids than min_aa.
+    dataset_df = data_common_process(dataset_df, min_aa)
+    # Step4: Delete low-confidence proteins.
+    unique_peptides = dataset_df.groupby(
+        PROTEIN_NAME, observed=True, sort=False
+    )[PEPTIDE_CANONICAL].transform("nunique")
+    dataset_df = dataset_df[unique_peptides >= min_unique]
+    # Step5: Filter decoy, contaminants, entrapment
+    if remove_decoy_contaminants:
+        dataset_df = remove_contaminants_entrapments_decoys(dataset_df)
+    # Step6: Filter user-specified proteins
+    if remove_ids is not None:
+        dataset_df = remove_protein_by_ids(dataset_df, remove_ids)
+    dataset_df.rename(columns={INTENSITY: NORM_INTENSITY}, inplace=True)
+    # Step7: Normalize at feature level between ms runs (technical repetitions)
+    if (
+            not skip_normalization
+            and nmethod != "none"
+            and technical_repetitions > 1
+    ):
+        print(f"{str(sample).upper()}: Normalize intensities of features.. ")
+        dataset_df = normalize_run(dataset_df, technical_repetitions, nmethod)
+        print(
+            f"{str(sample).upper()}: Number of features after normalization: {len(dataset_df.index)}"
+        )
+    # Step8: Merge peptidoforms across fractions and technical repetitions
+    dataset_df = get_peptidoform_normalize_intensities(dataset_df)
+    print(
+        f"{str(sample).upper()}: Number of peptides after peptidofrom selection: {len(dataset_df.index)}"
+    )
+    if len(dataset_df[FRACTION].unique().tolist()) > 1:
+        print(f"{str(sample).upper()}: Merge features across fractions.. ")
+        dataset_df = merge_fractions(dataset_df)
+        print(
+            f"{str(sample).upper()}: Number of features after merging fractions: {len(dataset_df.index)}"
+        )
+    # Step9: Normalize the data. Dividing by a constant commutes with the peptidoform
+    # sum, so the median is applied together with the log transformation in Step12.
+    median = None
+    if not skip_normalization:
+        if pnmethod == "globalMedian":
+            median = med_map[sample]
+        elif pnmethod == "conditionMedian":
+            con = dataset_df[CONDITION].unique()[0]
+            median = med_map[con][sample]
+
+    # Step10: Remove peptides with low frequency.
+    if low_frequency_peptides is not None:
+        peptides = pd.MultiIndex.from_arrays(
+            [dataset_df[PROTEIN_NAME], dataset_df[PEPTIDE_CANONICAL]]
+        )
+        dataset_df = dataset_df[~peptides.isin(low_frequency_peptides)]
+        print(
+            f"{str(sample).upper()}: Peptides after remove low frequency peptides: {len(dataset_df.index)}"
+        )
+
+    # Step11: Assembly peptidoforms to peptides.
+    print(f"{str(sample).upper()}: Sum all peptidoforms per Sample...")
+    dataset_df = sum_peptidoform_intensities(dataset_df)
+    print(
+        f"{str(sample).upper()}: Number of peptides after selection: {len(dataset_df.index)}"
+    )
+    # Step12: Intensity transformation to log, in one pass with the normalization.
+    if median is not None or log2:
+        intensities = dataset_df[NORM_INTENSITY].to_numpy(dtype=np.float32)
+        if median is not None:
+            np.divide(intensities, median, out=intensities)
+        if log2:
+            np.log2(intensities, out=intensities)
+        dataset_df[NORM_INTENSITY] = intensities
+
+    return dataset_df
+
+
+# Sample processing of a worker process, set once by init_sample_worker
+worker_process_sample = None
+
+
+def init_sample_worker(options: dict) -> None:
+    """
+    Bind the options shared by all the samples once in a worker process
+    :param options: Keyword arguments of process_sample other than the sample and its features
+    :return:
+    """
+    global worker_process_sample
+    worker_process_sample = functools.partial(process_sample, **options)
+
+
+def process_worker_sample(sample: str, dataset_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Normalize one sample with the options bound by init_sample_worker
+    :param sample: Sample accession
+    :param dataset_df: Features of the sample
+    :return: Normalized peptide intensities of the sample
+    """
+    return worker_process_sample(sample, dataset_df)
+
+
 def peptide_normalization(
         parquet: str,
         sdrf: str,
@@ -532,6 +717,7 @@ def peptide_normalization(
         pnmethod: str,
         log2: bool,
         save_parquet: bool,
+        workers: int = 1,
 ) -> None:
     """
 
@@ -548,6 +734,7 @@ def peptide_normalization(
     :param pnmethod: peptide normalization method
     :param log2: log intensities for features before normalizing
     :param save_parquet: Save to parque file.
+    :param workers: Number of processes used to normalize the samples
     """
     if os.path.exists(output):
         raise FileExistsError("The output file already exists.")
@@ -561,98 +748,75 @@ def peptide_normalization(
         technical_repetitions, label, sample_names, choice = analyse_sdrf(sdrf)
     else:
         technical_repetitions, label, sample_names, choice = feature.experimental_inference
-    if remove_low_frequency_peptides:
-        low_frequency_peptides = feature.low_frequency_peptides
-    header = False
+    low_frequency_peptides = None
+    if remove_low_frequency_peptides and len(sample_names) > 1:
+        # Built once, every sample is checked against the same hashed index
+        low_frequency_peptides = pd.MultiIndex.from_tuples(
+            feature.low_frequency_peptides, names=[PROTEIN_NAME, PEPTIDE_CANONICAL]
+        )
+    writer = parquet_writer = med_map = None
     if not skip_normalization and pnmethod == "globalMedian":
         med_map = feature.get_median_map()
     elif not skip_normalization and pnmethod == "conditionMedian":
         med_map = feature.get_median_map_to_condition()
-    for samples, df in feature.iter_samples():
-        for sample in samples:
-            # Perform data preprocessing on every sample
-            print(f"{str(sample).upper()}: Data preprocessing...")
-            dataset_df = df[df["sample_accession"] == sample].copy()
-            # Step1: Parse the identifier of proteins and retain only unique peptides.
-            dataset_df = dataset_df[dataset_df["unique"] == 1]
-            dataset_df = dataset_df[PARQUET_COLUMNS]
-            dataset_df = parquet_common_process(dataset_df, label, choice)
-            # Step2: Remove lines where intensity or study condition is empty.
-            # Step3: Filter peptides with less amino acids than min_aa.
-            dataset_df = data_common_process(dataset_df, min_aa)
-            # Step4: Delete low-confidence proteins.
-            dataset_df = dataset_df.groupby(PROTEIN_NAME).filter(
-                lambda x: len(set(x[PEPTIDE_CANONICAL])) >= min_unique
-            )
-            # Step5: Filter decoy, contaminants, entrapment
-            if remove_decoy_contaminants:
-                dataset_df = remove_contaminants_entrapments_decoys(dataset_df)
-            # Step6: Filter user-specified proteins
-            if remove_ids is not None:
-                dataset_df = remove_protein_by_ids(dataset_df, remove_ids)
-            dataset_df.rename(columns={INTENSITY: NORM_INTENSITY}, inplace=True)
-            # Step7: Normalize at feature level between ms runs (technical repetitions)
-            if (
-                    not skip_normalization
-                    and nmethod != "none"
-                    and technical_repetitions > 1
-            ):
-                print(f"{str(sample).upper()}: Normalize intensities of features.. ")
-                dataset_df = normalize_run(dataset_df, technical_repetitions, nmethod)
-                print(
-                    f"{str(sample).upper()}: Number of features after normalization: {len(dataset_df.index)}"
-                )
-            # Step8: Merge peptidoforms across fractions and technical repetitions
-            dataset_df = get_peptidoform_normalize_intensities(dataset_df)
-            print(
-                f"{str(sample).upper()}: Number of peptides after peptidofrom selection: {len(dataset_df.index)}"
-            )
-            if len(dataset_df[FRACTION].unique().tolist()) > 1:
-                print(f"{str(sample).upper()}: Merge features across fractions.. ")
-                dataset_df = merge_fractions(dataset_df)
-                print(
-                    f"{str(sample).upper()}: Number of features after merging fractions: {len(dataset_df.index)}"
-                )
-            # Step9: Normalize the data.
-            if not skip_normalization:
-                if pnmethod == "globalMedian":
-                    dataset_df.loc[:, NORM_INTENSITY] = (
-                            dataset_df[NORM_INTENSITY] / med_map[sample]
-                    )
-                elif pnmethod == "conditionMedian":
-                    con = dataset_df[CONDITION].unique()[0]
-                    dataset_df.loc[:, NORM_INTENSITY] = (
-                            dataset_df[NORM_INTENSITY] / med_map[con][sample]
-                    )
-            
-            # Step10: Remove peptides with low frequency.
-            if remove_low_frequency_peptides and len(sample_names) > 1:
-                dataset_df.set_index(
-                    [PROTEIN_NAME, PEPTIDE_CANONICAL], drop=True, inplace=True
-                )
-                dataset_df = dataset_df[
-                    ~dataset_df.index.isin(low_frequency_peptides)
-                ].reset_index()
-                print(
-                    f"{str(sample).upper()}: Peptides after remove low frequency peptides: {len(dataset_df.index)}"
-                )
-
-            # Step11: Assembly peptidoforms to peptides.
-            print(f"{str(sample).upper()}: Sum all peptidoforms per Sample...")
-            dataset_df = sum_peptidoform_intensities(dataset_df)
-            print(
-                f"{str(sample).upper()}: Number of peptides after selection: {len(dataset_df.index)}"
+    options = dict(
+        label=label,
+        choice=choice,
+        min_aa=min_aa,
+        min_unique=min_unique,
+        remove_ids=remove_ids,
+        remove_decoy_contaminants=remove_decoy_contaminants,
+        low_frequency_peptides=low_frequency_peptides,
+        skip_normalization=skip_normalization,
+        technical_repetitions=technical_repetitions,
+        nmethod=nmethod,
+        pnmethod=pnmethod,
+        med_map=med_map,
+        log2=log2,
+    )
+    # Samples are processed by a pool of worker processes when requested, the shared
+    # options are sent once to every worker and results are written in the order of
+    # the samples.
+    with (
+        ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_sample_worker,
+            initargs=(options,),
+        )
+        if workers > 1
+        else contextlib.nullcontext()
+    ) as executor:
+        if executor is not None:
+            map_samples = functools.partial(executor.map, process_worker_sample)
+        else:
+            map_samples = functools.partial(
+                map, functools.partial(process_sample, **options)
             )
-            # Step12: Intensity transformation to log.
-            if log2:
-                dataset_df[NORM_INTENSITY] = np.log2(dataset_df[NORM_INTENSITY])
-
-            print(f"{str(sample).upper()}: Save the normalized peptide intensities...")
-            if header:
-                dataset_df.to_csv(output, index=False, header=False, mode="a+")
-            else:
-                dataset_df.to_csv(output, index=False)
-                header = True
-
-    if save_parquet:
-        feature.csv2parquet(output)
+        # Unique peptides, non-zero intensities and non-empty conditions are selected by
+        # duckdb so the discarded features are never converted to pandas.
+        for samples, df in feature.iter_samples(
+                columns=PARQUET_COLUMNS,
+                where=""""unique" = 1 AND intensity > 0 AND condition IS DISTINCT FROM 'Empty'""",
+        ):
+            datasets = (df[df["sample_accession"] == sample] for sample in samples)
+            for sample, dataset_df in zip(samples, map_samples(samples, datasets)):
+                print(f"{str(sample).upper()}: Save the normalized peptide intensities...")
+                # The output files are opened once and every sample is appended as an Arrow
+                # table, the parquet file is written from the same table instead of the CSV.
+                table = to_arrow_table(dataset_df)
+                if writer is None:
+                    writer = pa_csv.CSVWriter(output, PEPTIDES_SCHEMA)
+                    if save_parquet:
+                        parquet_writer = pq.ParquetWriter(
+                            os.path.splitext(output)[0] + ".parquet",
+                            PEPTIDES_SCHEMA,
+                            compression="zstd",
+                        )
+                writer.write_table(table)
+                if parquet_writer is not None:
+                    parquet_writer.write_table(table)
+
+    if writer is not None:
+        writer.close()
+    if parquet_writer is not None:
+        parquet_writer.close()
@@ -27,6 +27,7 @@ setup(
     license="MIT",
     packages=find_packages(),
     include_package_data=True,
+    package_data={"ibaqpy": ["data/histones.json"]},
     install_requires=[
         "pyopenms",
         "scikit-learn",
@@ -1,5 +1,9 @@
+import os
+import tempfile
 from unittest import TestCase
 
+import pandas as pd
+
 from ibaqpy.ibaq.peptide_normalization import peptide_normalization
 from ibaqpy.ibaq.compute_ibaq import ibaq_compute
 
@@ -24,6 +28,28 @@ class TestIbaqpy(TestCase):
         print(args)
         peptide_normalization(**args)
 
+    def test_feature_assembly_workers(self):
+        args = {
+            "parquet": __package__ + "PXD003947/PXD003947-feature.parquet",
+            "sdrf": __package__ + "PXD003947/PXD003947.sdrf.tsv",
+            "min_aa": 7,
+            "min_unique": 2,
+            "remove_ids": __package__ + "../data/contaminants_ids.tsv",
+            "remove_decoy_contaminants": True,
+            "remove_low_frequency_peptides": True,
+            "skip_normalization": False,
+            "nmethod": "median",
+            "pnmethod": "globalMedian",
+            "log2": True,
+            "save_parquet": False,
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            serial = os.path.join(tmp_dir, "peptides-norm-serial.csv")
+            parallel = os.path.join(tmp_dir, "peptides-norm-parallel.csv")
+            peptide_normalization(output=serial, workers=1, **args)
+            peptide_normalization(output=parallel, workers=2, **args)
+            pd.testing.assert_frame_equal(pd.read_csv(serial), pd.read_csv(parallel))
+
     def test_ibaq_compute(self):
         args = {
             "fasta": __package__
@@ -39,3 +65,22 @@ class TestIbaqpy(TestCase):
         }
         print(args)
         ibaq_compute(**args)
+
+    def test_ibaq_compute_workers(self):
+        args = {
+            "fasta": __package__
+            + "PXD003947/Homo-sapiens-uniprot-reviewed-contaminants-decoy-202210.fasta",
+            "peptides": __package__ + "PXD003947/PXD003947-peptides-norm.csv",
+            "enzyme": "Trypsin",
+            "normalize": True,
+            "min_aa": 7,
+            "max_aa": 30,
+            "verbose": False,
+            "qc_report": None,
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            serial = os.path.join(tmp_dir, "ibaq-norm-serial.csv")
+            parallel = os.path.join(tmp_dir, "ibaq-norm-parallel.csv")
+            ibaq_compute(output=serial, workers=1, **args)
+            ibaq_compute(output=parallel, workers=2, **args)
+            pd.testing.assert_frame_equal(pd.read_csv(serial), pd.read_csv(parallel))